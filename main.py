@@ -1,13 +1,64 @@
 import os
+import asyncio
+import functools
+import logging
+import threading
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field, HttpUrl
-from typing import Optional, List
-import requests
-from bs4 import BeautifulSoup
-from database import create_document, get_documents
+from typing import Optional, List, Tuple
+import re
+from collections import Counter
+import httpx
+from cachetools import TTLCache
+from selectolax.lexbor import LexborHTMLParser
+from database import create_document, get_documents, get_collection
+from retrieval import TermIndex, tokenize
+
+# "index" ranks with the in-memory term index, "text" delegates to Mongo's $text search
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "index")
+
+# Shared client so ingests reuse pooled connections instead of blocking a worker thread
+_http = httpx.AsyncClient(
+    timeout=10,
+    follow_redirects=True,
+    headers={"User-Agent": "ai-docs-chatbot/1.0"},
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_indexes():
+    """Create the indexes the listing and retrieval queries rely on"""
+    get_collection("resource").create_index("tags")
+    get_collection("inverted_index").create_index("term", unique=True)
+    if SEARCH_BACKEND == "text":
+        # Only one text index is allowed per collection, and it slows every insert
+        get_collection("resource").create_index([("content", "text"), ("title", "text")])
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await asyncio.to_thread(create_indexes)
+    except Exception as e:
+        # Keep serving without a database, /test reports what is missing
+        logger.warning("Skipping index creation: %s", e)
+    try:
+        await asyncio.to_thread(term_index.backfill)
+    except Exception as e:
+        logger.warning("Skipping index backfill: %s", e)
+    yield
+    await _http.aclose()
 
-app = FastAPI(title="AI Docs Chatbot API")
+
+app = FastAPI(title="AI Docs Chatbot API", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+term_index = TermIndex()
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,7 +77,92 @@ class IngestRequest(BaseModel):
 
 class AskRequest(BaseModel):
     question: str = Field(..., min_length=3)
-    top_k: int = 3
+    top_k: int = Field(3, ge=1)
+
+
+_SENT_RE = re.compile(r"(?<=[.!?])\s+")
+_WS_RE = re.compile(r"\s+")
+
+# Recent answers keyed by (question, top_k); cleared whenever a resource is ingested
+_answer_cache = TTLCache(maxsize=1024, ttl=60)
+_answer_cache_lock = threading.Lock()
+# Bumped on every clear so an answer computed across an ingest isn't cached
+_answer_cache_generation = 0
+
+
+@functools.lru_cache(maxsize=4096)
+def tokenize_query(q: str) -> Tuple[str, ...]:
+    return tuple(tokenize(q))
+
+
+def index_search(q_counts: dict, top_k: int):
+    """Rank with the in-memory term index, then fetch only the winning docs"""
+    # Score every indexed doc against the query terms in one sparse product
+    ranked = term_index.search(q_counts, top_k)
+    if not ranked:
+        return []
+
+    # Fetch only the winning docs, keeping their rank order
+    ranked_ids = [doc_id for doc_id, _ in ranked]
+    by_id = {
+        d["_id"]: d
+        for d in get_documents("resource", {"_id": {"$in": ranked_ids}}, projection={"title": 1, "url": 1, "content": 1})
+    }
+    return [by_id[doc_id] for doc_id in ranked_ids if doc_id in by_id]
+
+
+def text_search(question: str, top_k: int):
+    """Rank with Mongo's full-text index, scoring happens inside the server"""
+    cursor = get_collection("resource").find(
+        {"$text": {"$search": question}},
+        {"score": {"$meta": "textScore"}, "title": 1, "url": 1, "content": 1},
+    )
+    return list(cursor.sort([("score", {"$meta": "textScore"})]).limit(top_k))
+
+
+def extract_snippets(text: str, q_terms: List[str], max_chars: int = 600):
+    """Pull the sentences of text that mention any of the query terms"""
+    if not q_terms:
+        return text[:max_chars]
+    # One alternation matching whole tokens the way tokenize() splits them
+    pat = re.compile(
+        r"(?<![a-zA-Z0-9])(?:" + "|".join(map(re.escape, set(q_terms))) + r")(?![a-zA-Z0-9])",
+        re.IGNORECASE,
+    )
+    sentences = _SENT_RE.split(text)
+    selected = []
+    selected_len = 0
+    for s in sentences:
+        if pat.search(s):
+            s = s.strip()
+            selected.append(s)
+            selected_len += len(s)
+            if selected_len > max_chars:
+                break
+    if selected:
+        return " ".join(selected)[:max_chars]
+    return text[:max_chars]
+
+
+def parse_page(html: str):
+    """Extract the page title, plain text and term frequencies from HTML"""
+    # Basic content extraction using selectolax, which walks lexbor's C tree
+    # without building a Python object per node
+    tree = LexborHTMLParser(html)
+    # Remove script and style tags
+    tree.strip_tags(["script", "style", "noscript"])
+    title_node = tree.css_first("title")
+    title = (title_node.text().strip() if title_node else "") or None
+
+    root = tree.body or tree.root
+    body = root.text(separator=" ") if root else ""
+    # Lead with the title, as the full-document text did, so its words stay searchable
+    if title and tree.body:
+        body = title + " " + body
+    text = _WS_RE.sub(" ", body).strip()
+
+    # Count terms once at ingest so /api/ask only has to look up query terms
+    return title, text, Counter(tokenize(text))
 
 
 @app.get("/")
@@ -35,21 +171,16 @@ def read_root():
 
 
 @app.post("/api/ingest")
-def ingest_resource(payload: IngestRequest):
+async def ingest_resource(payload: IngestRequest):
     try:
-        resp = requests.get(str(payload.url), timeout=10)
+        resp = await _http.get(str(payload.url))
         resp.raise_for_status()
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to fetch URL: {e}")
 
-    # Basic content extraction using BeautifulSoup
-    soup = BeautifulSoup(resp.text, "html.parser")
-    # Remove script and style tags
-    for tag in soup(["script", "style", "noscript"]):
-        tag.decompose()
-    text = " ".join(soup.get_text(separator=" ").split())
-
-    title = payload.title or (soup.title.string.strip() if soup.title and soup.title.string else str(payload.url))
+    # Parsing is CPU-bound, keep it off the event loop
+    page_title, text, term_freq = await asyncio.to_thread(parse_page, resp.text)
+    title = payload.title or page_title or str(payload.url)
 
     doc = {
         "title": title,
@@ -58,11 +189,26 @@ def ingest_resource(payload: IngestRequest):
         "tags": payload.tags or [],
     }
 
-    try:
+    def store():
         doc_id = create_document("resource", doc)
+        try:
+            term_index.add_document(doc_id, term_freq)
+        except Exception:
+            # Don't leave behind a row that would show up in answers after a 500
+            term_index.remove_document(doc_id, term_freq)
+            raise
+        return doc_id
+
+    try:
+        doc_id = await asyncio.to_thread(store)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
 
+    global _answer_cache_generation
+    with _answer_cache_lock:
+        _answer_cache.clear()
+        _answer_cache_generation += 1
+
     return {"status": "ok", "id": doc_id, "title": title, "length": len(text)}
 
 
@@ -70,83 +216,64 @@ def ingest_resource(payload: IngestRequest):
 def list_resources(tag: Optional[str] = None, limit: int = 20):
     try:
         filt = {"tags": {"$in": [tag]}} if tag else {}
-        items = get_documents("resource", filt, limit)
-        # Convert ObjectId and datetime fields to strings for JSON serialization
-        from bson import ObjectId
-        from datetime import datetime
-        def normalize(d):
-            out = {}
-            for k, v in d.items():
-                if isinstance(v, ObjectId):
-                    out[k] = str(v)
-                elif isinstance(v, datetime):
-                    out[k] = v.isoformat()
-                else:
-                    out[k] = v
-            return out
-        return [normalize(i) for i in items]
+        # Leave the full text and term counts in Mongo, listings only show metadata
+        projection = {"title": 1, "url": 1, "tags": 1, "created_at": 1, "updated_at": 1}
+        items = get_documents("resource", filt, limit, projection)
+        return [
+            {
+                "_id": str(d["_id"]),
+                "title": d.get("title"),
+                "url": d.get("url"),
+                "tags": d.get("tags", []),
+                "created_at": d["created_at"].isoformat() if "created_at" in d else None,
+                "updated_at": d["updated_at"].isoformat() if "updated_at" in d else None,
+            }
+            for d in items
+        ]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
 
 
 @app.post("/api/ask")
 def ask_question(payload: AskRequest):
-    # Very simple retrieval: keyword overlap + cosine-like scoring on term frequency
+    # Very simple retrieval: keyword overlap + cosine scoring on term frequency
     question = payload.question.strip()
     if not question:
         raise HTTPException(status_code=400, detail="Empty question")
 
-    try:
-        # Fetch a reasonable number of docs
-        docs = get_documents("resource", {}, 100)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+    # Matching is case-insensitive, so retries that only differ in case share an answer
+    key = (question.lower(), payload.top_k)
+    with _answer_cache_lock:
+        cached = _answer_cache.get(key)
+        generation = _answer_cache_generation
+    if cached is not None:
+        return cached
 
-    if not docs:
-        return {"answer": "I don't have any resources yet. Please add a website or docs first.", "sources": []}
+    result = answer_question(question, payload.top_k)
+    with _answer_cache_lock:
+        if generation == _answer_cache_generation:
+            _answer_cache[key] = result
+    return result
 
-    import math
-    import re
-    from collections import Counter
 
-    def tokenize(t: str):
-        return [w.lower() for w in re.findall(r"[a-zA-Z0-9]+", t)]
-
-    q_tokens = tokenize(question)
+def answer_question(question: str, top_k: int):
+    q_tokens = tokenize_query(question)
     q_counts = Counter(q_tokens)
 
-    # Compute simple TF score per doc on query terms, then select top_k
-    scored = []
-    for d in docs:
-        content = d.get("content", "")
-        tokens = tokenize(content)
-        if not tokens:
-            continue
-        counts = Counter(tokens)
-        score = sum(counts[t] for t in q_tokens)
-        if score > 0:
-            scored.append((score, d))
-
-    if not scored:
-        return {"answer": "I couldn't find information about that in the provided resources.", "sources": []}
+    try:
+        if SEARCH_BACKEND == "text":
+            top = text_search(question, top_k)
+        else:
+            top = index_search(q_counts, top_k)
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    top = [d for _, d in scored[: payload.top_k]]
+        if not top:
+            if get_collection("resource").find_one({}, {"_id": 1}) is None:
+                return {"answer": "I don't have any resources yet. Please add a website or docs first.", "sources": []}
+            return {"answer": "I couldn't find information about that in the provided resources.", "sources": []}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
 
     # Compose a concise extract answer by pulling the most relevant sentences containing query terms
-    def extract_snippets(text: str, q_terms: List[str], max_chars: int = 600):
-        sentences = re.split(r"(?<=[.!?])\s+", text)
-        selected = []
-        for s in sentences:
-            s_low = s.lower()
-            if any(t in s_low for t in q_terms):
-                selected.append(s.strip())
-            if sum(len(x) for x in selected) > max_chars:
-                break
-        if selected:
-            return " ".join(selected)[:max_chars]
-        return text[:max_chars]
-
     snippets = [extract_snippets(d.get("content", ""), q_tokens) for d in top]
     combined = " \n\n".join(snippets)
 
@@ -157,21 +284,7 @@ def ask_question(payload: AskRequest):
     )
 
     # Prepare sources metadata
-    def normalize_source(d):
-        from bson import ObjectId
-        from datetime import datetime
-        out = {}
-        for k, v in d.items():
-            if isinstance(v, ObjectId):
-                out[k] = str(v)
-            elif isinstance(v, datetime):
-                out[k] = v.isoformat()
-            else:
-                out[k] = v
-        # keep only small subset
-        return {"id": out.get("_id"), "title": out.get("title"), "url": out.get("url")}
-
-    sources = [normalize_source(d) for d in top]
+    sources = [{"id": str(d["_id"]), "title": d.get("title"), "url": d.get("url")} for d in top]
 
     return {"answer": answer, "sources": sources}
 
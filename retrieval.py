@@ -0,0 +1,266 @@
+"""
+Retrieval Index
+
+Term-document index used by /api/ask. Postings are persisted in the
+"inverted_index" collection (one document per term) and cached in memory
+as a term-major SciPy CSC matrix, so a query only reads the columns of
+its own terms instead of every stored count.
+"""
+
+import logging
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from scipy.sparse import csc_matrix, vstack
+
+from database import get_collection
+
+_TOKEN_RE = re.compile(r"[a-zA-Z0-9]+")
+
+# Term counts are stored as uint16, clipping the rare term seen more than 65535 times
+_MAX_COUNT = np.iinfo(np.uint16).max
+
+# Bumped on every write to the inverted index so other workers know to reload
+_VERSION_KEY = {"_id": "inverted_index"}
+
+logger = logging.getLogger(__name__)
+
+
+def tokenize(t: str):
+    return _TOKEN_RE.findall(t.lower())
+
+
+def _counts(data: list) -> np.ndarray:
+    return np.minimum(np.asarray(data, dtype=np.int64), _MAX_COUNT).astype(np.uint16)
+
+
+def term_norm(term_freq: dict) -> float:
+    """L2 norm of a term frequency vector"""
+    return math.sqrt(sum(c * c for c in term_freq.values()))
+
+
+def _row_norms(matrix: csc_matrix) -> np.ndarray:
+    # CSC indices are row numbers, so bincount sums each row's squared counts
+    squares = matrix.data.astype(np.float64) ** 2
+    return np.sqrt(np.bincount(matrix.indices, weights=squares, minlength=matrix.shape[0])).astype(np.float32)
+
+
+class TermIndex:
+    """In-memory CSC matrix of shape (n_docs, vocab_size) holding uint16 term counts
+
+    Rows are ranked by cosine similarity on raw term frequency, using each
+    row's L2 norm computed once when the matrix is built.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Signalled when a rebuild finishes so searches waiting on it can use it
+        self._loaded = threading.Condition(self._lock)
+        self._loading = False
+        # Count rebuilds started and local writes, so an ingest can tell whether a
+        # rebuild may have read its postings half-written
+        self._loads = 0
+        self._writes = 0
+        # Count rebuilds installed, so a waiter knows when the one it waited on is done
+        self._builds = 0
+        # Index version the matrix was built at, and whether it must be rebuilt anyway
+        self._version = 0
+        self._stale = True
+        self._vocab: Dict[str, int] = {}
+        self._doc_ids: List[ObjectId] = []
+        self._matrix = csc_matrix((0, 0), dtype=np.uint16)
+        self._norms = np.zeros(0, dtype=np.float32)
+        # Rows ingested by this process that aren't stacked into the matrix yet
+        self._pending: List[Tuple[ObjectId, dict]] = []
+
+    def add_document(self, doc_id: str, term_freq: dict):
+        """Persist a document's postings and term stats, then append its row to the matrix"""
+        doc_id = ObjectId(doc_id)
+        with self._lock:
+            loads, loading = self._loads, self._loading
+        if term_freq:
+            self._write_postings(doc_id, term_freq)
+            version = self._bump_version()
+        # term_freq goes on the row only once every other worker has been told to
+        # reload, so a failure before this leaves the row for backfill to find
+        self._set_term_stats(doc_id, term_freq)
+        if not term_freq:
+            return
+
+        with self._lock:
+            self._writes += 1
+            unchanged = not loading and not self._loading and self._loads == loads
+            if unchanged and not self._stale and version == self._version + 1:
+                self._pending.append((doc_id, term_freq))
+                self._version = version
+            else:
+                # Another worker wrote in between, or a rebuild may already hold some
+                # of these postings; rebuild on the next search
+                self._stale = True
+
+    def remove_document(self, doc_id: str, term_freq: dict):
+        """Best-effort undo of a failed add_document, dropping the row and its postings"""
+        doc_id = ObjectId(doc_id)
+        try:
+            if term_freq:
+                get_collection("inverted_index").update_many(
+                    {"term": {"$in": list(term_freq)}}, {"$pull": {"postings": {"doc_id": doc_id}}}
+                )
+            get_collection("resource").delete_one({"_id": doc_id})
+            self._bump_version()
+        except Exception as e:
+            # The row still has no term_freq, so the next startup backfill indexes it
+            logger.warning("Could not remove resource %s: %s", doc_id, e)
+        with self._lock:
+            # Other workers may have loaded the postings before they were pulled
+            self._stale = True
+
+    def search(self, q_counts: Dict[str, int], top_k: int) -> List[Tuple[ObjectId, float]]:
+        """Return up to top_k (doc_id, score) pairs with a non-zero score, best first"""
+        if not q_counts:
+            return []
+
+        meta = get_collection("index_meta").find_one(_VERSION_KEY)
+        version = meta["version"] if meta else 0
+
+        with self._loaded:
+            load = False
+            if self._loading and self._stale:
+                # The matrix is out of date and a rebuild is in flight: use what it
+                # installs, even if a write lands meanwhile, rather than start another
+                builds = self._builds
+                while self._loading and self._builds == builds:
+                    self._loaded.wait()
+            elif not self._loading and (self._stale or version > self._version):
+                self._loading = True
+                self._loads += 1
+                writes = self._writes
+                load = True
+            # Otherwise up to date (a local append may be ahead of the version read
+            # above), or another search is rebuilding from a usable snapshot
+            if not load and self._pending:
+                self._stack_pending()
+            matrix, norms, vocab, doc_ids = self._matrix, self._norms, self._vocab, self._doc_ids
+
+        if load:
+            # Read Mongo without the lock so other searches keep their snapshot
+            built = None
+            try:
+                built = self._build()
+            finally:
+                with self._loaded:
+                    if built is not None:
+                        self._matrix, self._norms, self._vocab, self._doc_ids = built
+                        self._pending = []
+                        self._version = version
+                        # A local write during the rebuild may be only partly in it
+                        self._stale = self._writes != writes
+                        self._builds += 1
+                    self._loading = False
+                    self._loaded.notify_all()
+            matrix, norms, vocab, doc_ids = built
+
+        cols = [vocab[t] for t in q_counts if t in vocab]
+        if not cols:
+            # None of the query terms was ever ingested, so nothing can match
+            return []
+        # float32 weights so the product upcasts instead of overflowing uint16
+        weights = np.asarray([q_counts[t] for t in q_counts if t in vocab], dtype=np.float32)
+        # Slicing columns touches only the postings of the query terms
+        dots = np.asarray(matrix[:, cols] @ weights).ravel()
+        # Cosine on term frequency so long documents don't win on length alone
+        q_norm = term_norm(q_counts)
+        scores = np.divide(dots, norms * q_norm, out=np.zeros_like(dots), where=dots > 0)
+
+        hits = np.flatnonzero(scores)
+        if len(hits) > top_k:
+            hits = hits[np.argpartition(-scores[hits], top_k)[:top_k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(doc_ids[i], float(scores[i])) for i in hits]
+
+    def _write_postings(self, doc_id: ObjectId, term_freq: dict):
+        ops = [
+            UpdateOne({"term": term}, {"$push": {"postings": {"doc_id": doc_id, "tf": tf}}}, upsert=True)
+            for term, tf in term_freq.items()
+        ]
+        get_collection("inverted_index").bulk_write(ops, ordered=False)
+
+    def _bump_version(self) -> int:
+        meta = get_collection("index_meta").find_one_and_update(
+            _VERSION_KEY, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        return meta["version"]
+
+    def _set_term_stats(self, doc_id: ObjectId, term_freq: dict):
+        get_collection("resource").update_one(
+            {"_id": doc_id},
+            {"$set": {"term_freq": dict(term_freq), "length": sum(term_freq.values())}},
+        )
+
+    def backfill(self) -> int:
+        """Index resources whose postings were never stored, returning how many
+
+        Run once at startup: rows only lack term_freq if they predate the index
+        or an ingest failed and couldn't be undone.
+        """
+        resources = get_collection("resource")
+        indexed = []
+        for d in resources.find({"term_freq": {"$exists": False}}, {"content": 1}):
+            # Postings written twice for the same row are collapsed by _build
+            term_freq = Counter(tokenize(d.get("content", "")))
+            if term_freq:
+                self._write_postings(d["_id"], term_freq)
+            indexed.append((d["_id"], term_freq))
+        backfilled = sum(1 for _, term_freq in indexed if term_freq)
+        if backfilled:
+            self._bump_version()
+        # As in add_document, mark rows indexed only after the version bump
+        for doc_id, term_freq in indexed:
+            self._set_term_stats(doc_id, term_freq)
+        return backfilled
+
+    def _build(self):
+        """Build a matrix from the persisted postings"""
+        vocab: Dict[str, int] = {}
+        rows: Dict[ObjectId, int] = {}
+        row_idx, col_idx, data = [], [], []
+        for entry in get_collection("inverted_index").find({}, {"_id": 0}):
+            col = vocab.setdefault(entry["term"], len(vocab))
+            # A retried ingest or backfill can push the same posting again
+            for doc_id, tf in {p["doc_id"]: p["tf"] for p in entry["postings"]}.items():
+                row_idx.append(rows.setdefault(doc_id, len(rows)))
+                col_idx.append(col)
+                data.append(tf)
+
+        matrix = csc_matrix((_counts(data), (row_idx, col_idx)), shape=(len(rows), len(vocab)))
+        return matrix, _row_norms(matrix), vocab, list(rows)
+
+    def _stack_pending(self):
+        """Append rows ingested by this process since the last search"""
+        vocab = dict(self._vocab)
+        doc_ids = list(self._doc_ids)
+        row_idx, col_idx, data = [], [], []
+        for row, (doc_id, term_freq) in enumerate(self._pending):
+            doc_ids.append(doc_id)
+            for term, tf in term_freq.items():
+                row_idx.append(row)
+                col_idx.append(vocab.setdefault(term, len(vocab)))
+                data.append(tf)
+
+        new_rows = csc_matrix(
+            (_counts(data), (row_idx, col_idx)), shape=(len(self._pending), len(vocab))
+        )
+        old = self._matrix.copy()
+        old.resize((old.shape[0], len(vocab)))
+        # Searches in flight keep their snapshot, so swap in new objects
+        self._matrix = vstack([old, new_rows], format="csc")
+        self._norms = np.concatenate([self._norms, _row_norms(new_rows)])
+        self._vocab = vocab
+        self._doc_ids = doc_ids
+        self._pending = []